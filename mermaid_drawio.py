@@ -1,25 +1,59 @@
 import gradio as gr
 import base64
+import functools
+import hashlib
 import tempfile
 import os
-import xml.etree.ElementTree as ET
-import zlib
+from xml.sax.saxutils import escape
+import deflate
 import re
-from collections import defaultdict, deque
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Extra entities so escaped values are safe inside double-quoted attributes;
+# a literal tab would be normalised to a space by the XML parser
+_ATTR_ENTITIES = {'"': "&quot;", '\t': "&#09;"}
+# Characters that force an attribute value through escape()
+_ATTR_SPECIAL_RE = re.compile(r'[<>&"\t]')
+
+# draw.io cells share a fixed attribute set, so they are written from fixed templates
+_NODE_FMT = (
+    '<mxCell id="{id}" value="{value}" style="rounded=1;whiteSpace=wrap;html=1;" '
+    'parent="1" vertex="1"><mxGeometry as="geometry" x="{x}" y="{y}" '
+    'width="120" height="60"/></mxCell>'
+)
+_EDGE_FMT = (
+    '<mxCell id="{id}" value="{value}" '
+    'style="edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;" '
+    'parent="1" source="{source}" target="{target}" edge="1">'
+    '<mxGeometry as="geometry" relative="1"/></mxCell>'
+)
+
+# "graph TD" / "graph LR" header; must be the whole line, so "Graph db --> Cache" stays an edge
+_GRAPH_RE = re.compile(r'^graph\s+(\w+)\s*;?$')
+
+
+def _xml_attr(value):
+    """Escape value for a double-quoted XML attribute; plain values pass through untouched."""
+    if _ATTR_SPECIAL_RE.search(value):
+        return escape(value, _ATTR_ENTITIES)
+    return value
 
+
+@functools.lru_cache(maxsize=256)
 def parse_mermaid(mermaid_code):
     """
     Parse simple flowchart lines from Mermaid code:
       graph TD
       A --> B
       B -- label --> C
-    Returns:
-      nodes: set of node_ids (strings)
-      edges: list of (source_id, target_id, edge_label)
+    Returns (immutable, since results are cached):
+      nodes: tuple of node_ids (strings), in order of first appearance
+      edges: tuple of (source_id, target_id, edge_label)
       direction: "TD" or "LR"
     """
-    nodes = set()
+    nodes = {}  # insertion-ordered set (values unused)
     edges = []
     direction = "TD"  # default top-down
 
@@ -29,42 +63,27 @@ def parse_mermaid(mermaid_code):
         if not line:
             continue
 
-        # 1) Check if line starts with 'graph' to get direction
-        if line.startswith("graph "):
+        # 1) Check if the line is a 'graph' header to get direction
+        if m := _GRAPH_RE.match(line):
             # e.g. "graph TD" or "graph LR"
-            parts = line.split()
-            if len(parts) >= 2:
-                direction = parts[1].upper()
+            direction = m.group(1).upper()
 
         # 2) Check for edges: anything with '-->'
         elif '-->' in line:
             # Example lines:
             #   A --> B
             #   A -- label --> B
-            # We'll do a simple split on '-->'
-            left, right = line.split('-->', 1)
-            left = left.strip()
-            right = right.strip()
-
-            # If there's a '--' in the left part, it's "node -- label"
-            # e.g. "A -- label"
-            # Otherwise it's just "A"
-            if '--' in left:
-                left_node_part, edge_label = left.split('--', 1)
-                left_node_part = left_node_part.strip()
-                edge_label = edge_label.strip()
-            else:
-                left_node_part = left
-                edge_label = ""
-
-            # The source node ID will be everything in left_node_part.
-            # The target node ID is everything in right.
-            source_id = left_node_part
-            target_id = right
+            # Split on the first '-->', then the left part on its first '--'
+            # (partition is one C call per split, with no list allocated)
+            left, _, target_id = line.partition('-->')
+            source_id, _, edge_label = left.partition('--')
+            source_id = source_id.strip()
+            target_id = target_id.strip()
+            edge_label = edge_label.strip()
 
             # Add them to the set of nodes
-            nodes.add(source_id)
-            nodes.add(target_id)
+            nodes[source_id] = None
+            nodes[target_id] = None
 
             # Add the edge
             edges.append((source_id, target_id, edge_label))
@@ -72,169 +91,144 @@ def parse_mermaid(mermaid_code):
         else:
             # Possibly a standalone node definition line, e.g. "A" or "A[Something]"
             # We'll just treat it as a node. For the ID, we can use the entire line.
-            nodes.add(line)
+            nodes[line] = None
 
-    return nodes, edges, direction
+    return tuple(nodes), tuple(edges), direction
 
 
 def compute_layout(nodes, edges, direction="TD"):
     """
-    Very basic BFS layering approach to place nodes either top-down (TD) or left-right (LR).
+    Very basic BFS layering approach (Kahn's algorithm, longest-path layers)
+    to place nodes either top-down (TD) or left-right (LR).
     Returns a dict: {node_id: (x, y)}
     """
     if not nodes:
         return {}
 
-    # Build adjacency + in-degree
-    adj = defaultdict(list)
-    indeg = {nid: 0 for nid in nodes}
+    # Build adjacency + in-degree in a single pass over the edges
+    adj = {}
+    indeg = dict.fromkeys(nodes, 0)
     for (s, t, lbl) in edges:
-        adj[s].append(t)
+        adj.setdefault(s, []).append(t)
         indeg[t] += 1
 
-    # queue of nodes with indegree=0
-    from collections import deque
-    queue = deque(n for n in indeg if indeg[n] == 0)
-    depth = {n: 0 for n in nodes}  # BFS layer
+    # first layer: nodes with indegree=0
+    frontier = [n for n in nodes if indeg[n] == 0]
     coords = {}
+    d = 0  # BFS layer
+
+    # Walk one layer at a time, placing each node as its layer is reached
+    while len(coords) < len(nodes):
+        if not frontier:
+            # Nodes on a cycle never reach indegree 0; give them a layer of their own
+            frontier = [n for n in nodes if indeg[n] > 0]
+            for n in frontier:
+                indeg[n] = 0
+
+        next_frontier = []
+        for offset_in_layer, current in enumerate(frontier):
+            if direction == "LR":
+                # x ~ depth, y ~ offset
+                x = d * 200
+                y = offset_in_layer * 120
+            else:
+                # default: TD => y ~ depth, x ~ offset
+                y = d * 200
+                x = offset_in_layer * 200
 
-    while queue:
-        current = queue.popleft()
-        for child in adj[current]:
-            indeg[child] -= 1
-            if indeg[child] == 0:
-                depth[child] = depth[current] + 1
-                queue.append(child)
-
-    # Sort nodes by (depth, alphabetical) for stable layout
-    sorted_nodes = sorted(nodes, key=lambda x: (depth[x], x))
-
-    # Track how many we've placed in each layer
-    layer_counts = defaultdict(int)
-
-    for n in sorted_nodes:
-        d = depth[n]
-        offset_in_layer = layer_counts[d]
-        layer_counts[d] += 1
-
-        if direction == "LR":
-            # x ~ depth, y ~ offset
-            x = d * 200
-            y = offset_in_layer * 120
-        else:
-            # default: TD => y ~ depth, x ~ offset
-            y = d * 200
-            x = offset_in_layer * 200
+            coords[current] = (x, y)
 
-        coords[n] = (x, y)
+            for child in adj.get(current, ()):
+                indeg[child] -= 1
+                if indeg[child] == 0:
+                    next_frontier.append(child)
+
+        # No sorting: layers keep input (discovery) order, which is already stable
+        frontier = next_frontier
+        d += 1
 
     return coords
 
 
-def mermaid_to_drawio(mermaid_code):
+@functools.lru_cache(maxsize=256)
+def mermaid_to_drawio(mermaid_code, level=1):
     """
     Convert Mermaid code to draw.io XML (compressed+base64).
-    All nodes use the same style. 
+    All nodes use the same style. Results are cached per input.
+    level: deflate level; 1 is fastest and fine for a one-off URL,
+      use 6 for smaller output you intend to keep.
     """
     # 1) Parse
     nodes, edges, direction = parse_mermaid(mermaid_code)
     # 2) Layout
     coords = compute_layout(nodes, edges, direction)
 
-    # 3) Build XML
-    mxfile = ET.Element("mxfile")
-    diagram = ET.SubElement(mxfile, "diagram")
-    mxGraphModel = ET.SubElement(diagram, "mxGraphModel")
-    root = ET.SubElement(mxGraphModel, "root")
-
-    # Default layer
-    ET.SubElement(root, "mxCell", id="0")
-    ET.SubElement(root, "mxCell", id="1", parent="0")
-
-    # Add node cells
-    node_id_map = {}
-    cell_counter = 2
-
-    for node_str in nodes:
-        cell_id = str(cell_counter)
-        cell_counter += 1
-        node_id_map[node_str] = cell_id
-
-        # We'll just use the node string as the label
-        label = node_str
-
-        style = "rounded=1;whiteSpace=wrap;html=1;"  # All nodes same style
-        mxCell = ET.SubElement(root, "mxCell", {
-            "id": cell_id,
-            "value": label,
-            "style": style,
-            "parent": "1",
-            "vertex": "1"
-        })
+    # 3) Build XML directly into a byte buffer (fixed schema, no element tree)
+    buf = bytearray()
+    buf.extend(b'<mxfile><diagram><mxGraphModel><root>'
+               b'<mxCell id="0"/><mxCell id="1" parent="0"/>')
+
+    # Add node cells; ids 0 and 1 are the default layer, nodes follow, then edges
+    node_id_map = {n: str(i) for i, n in enumerate(nodes, start=2)}
+    next_id = len(nodes) + 2
 
+    for node_str, cell_id in node_id_map.items():
         x, y = coords.get(node_str, (0, 0))  # default (0,0) if missing
-        ET.SubElement(mxCell, "mxGeometry", {
-            "as": "geometry",
-            "x": str(x),
-            "y": str(y),
-            "width": "120",
-            "height": "60"
-        })
+        # We'll just use the node string as the label; all nodes same style
+        buf.extend(_NODE_FMT.format(id=cell_id, value=_xml_attr(node_str), x=x, y=y).encode('utf-8'))
 
     # Add edges
     for (s, t, lbl) in edges:
-        edge_id = str(cell_counter)
-        cell_counter += 1
+        edge_id = str(next_id)
+        next_id += 1
         source_cell = node_id_map[s]
         target_cell = node_id_map[t]
 
-        edge_style = "edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;"
-        edge_cell = ET.SubElement(root, "mxCell", {
-            "id": edge_id,
-            "value": lbl,
-            "style": edge_style,
-            "parent": "1",
-            "source": source_cell,
-            "target": target_cell,
-            "edge": "1"
-        })
-        ET.SubElement(edge_cell, "mxGeometry", {
-            "as": "geometry",
-            "relative": "1"
-        })
-
-    # 4) Convert XML to string and compress
-    xml_string = ET.tostring(mxfile, encoding="utf-8", method="xml").decode()
-    compressed_xml = zlib.compress(xml_string.encode('utf-8'), level=-1, wbits=-15)
+        buf.extend(_EDGE_FMT.format(
+            id=edge_id, value=_xml_attr(lbl), source=source_cell, target=target_cell
+        ).encode('utf-8'))
+
+    buf.extend(b'</root></mxGraphModel></diagram></mxfile>')
+
+    # 4) Compress the buffer as-is (no str round-trip or bytes copy)
+    compressed_xml = deflate.deflate_compress(buf, level)  # raw deflate, as draw.io expects
     encoded_xml = base64.b64encode(compressed_xml).decode('utf-8')
     return encoded_xml
 
 
-def render_mermaid_and_drawio(mermaid_code):
-    """
-    1) Render Mermaid code in an iframe locally.
-    2) Provide a .mmd file download.
-    3) Generate a draw.io link using the simpler parser.
-    """
+MERMAID_JS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/mermaid/10.2.4/mermaid.min.js'
 
-    # Load mermaid.min.js for local rendering
+# Shared session: keeps the CDN connection alive and retries transient failures,
+# including 429/5xx answers (the download runs at import, so one would stop the app)
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(max_retries=Retry(
+    total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)
+)))
 
-    mermaid_js_path=('https://cdnjs.cloudflare.com/ajax/libs/mermaid/10.2.4/mermaid.min.js')
+
+def _load_mermaid_js():
+    """
+    Load mermaid.min.js for local rendering: the local copy if present,
+    otherwise download it from the CDN.
+    """
     try:
         with open("mermaid.min.js", "rb") as f:
-            mermaid_js_raw = f.read()
-    except:
-        response = requests.get(mermaid_js_path, stream=True)  # stream=True for large files
-    
-        mermaid_js_raw = response.content  # Use response.content for binary data    
-    
-    mermaid_js_b64 = base64.b64encode(mermaid_js_raw).decode("utf-8")
-
-    html_template = f"""
+            return f.read()
+    except OSError:
+        response = _SESSION.get(MERMAID_JS_URL, timeout=10)
+        response.raise_for_status()  # fail loudly rather than embed an error page
+        return response.content  # Use response.content for binary data
+
+
+# Loaded and encoded once per process, not on every request
+_MERMAID_JS_B64 = base64.b64encode(_load_mermaid_js()).decode("utf-8")
+
+# The page around the user's Mermaid code never changes, so it is built once
+_HTML_TEMPLATE_PREFIX = f"""
     <!DOCTYPE html>
     <html>
     <head>
-        <script src="data:application/javascript;base64,{mermaid_js_b64}"></script>
+        <script src="data:application/javascript;base64,{_MERMAID_JS_B64}"></script>
         <script>
             document.addEventListener('DOMContentLoaded', function() {{
                 mermaid.initialize({{ startOnLoad: true }});
@@ -257,20 +251,56 @@ def render_mermaid_and_drawio(mermaid_code):
     </head>
     <body>
         <div class="mermaid">
-            {mermaid_code}
+            """
+_HTML_TEMPLATE_SUFFIX = """
         </div>
     </body>
     </html>
     """
 
-    # For the iframe srcdoc, we must escape quotes
-    safe_html = html_template.replace('"', "&quot;").replace("'", "&#x27;")
-    iframe_html = f'<iframe srcdoc="{safe_html}" width="100%" height="500px" frameborder="0"></iframe>'
 
-    # Create a temporary .mmd file for download
-    with tempfile.NamedTemporaryFile(suffix=".mmd", delete=False, mode="w", encoding="utf-8") as tmp:
-        tmp.write(mermaid_code)
-        tmp_path = tmp.name
+def _escape_srcdoc(html):
+    """Escape quotes so html can sit inside an iframe srcdoc attribute."""
+    return html.replace('"', "&quot;").replace("'", "&#x27;")
+
+
+# Escaped once here instead of rescanning the whole mermaid.js payload per request
+_SAFE_HTML_PREFIX = _escape_srcdoc(_HTML_TEMPLATE_PREFIX)
+_SAFE_HTML_SUFFIX = _escape_srcdoc(_HTML_TEMPLATE_SUFFIX)
+
+# Private (0700) directory for the .mmd downloads, so other local users cannot plant files in it
+_MMD_DIR = tempfile.mkdtemp(prefix="mmd_")
+
+
+def render_mermaid_and_drawio(mermaid_code):
+    """
+    1) Render Mermaid code in an iframe locally.
+    2) Provide a .mmd file download.
+    3) Generate a draw.io link using the simpler parser.
+    """
+    # For the iframe srcdoc, we must escape quotes; only the user's code needs it per request
+    safe_code = _escape_srcdoc(mermaid_code)
+    iframe_html = (
+        f'<iframe srcdoc="{_SAFE_HTML_PREFIX}{safe_code}{_SAFE_HTML_SUFFIX}" '
+        'width="100%" height="500px" frameborder="0"></iframe>'
+    )
+
+    # .mmd file for download, named by content hash so identical inputs reuse one file
+    key = hashlib.blake2b(mermaid_code.encode('utf-8'), digest_size=16).hexdigest()
+    tmp_path = os.path.join(_MMD_DIR, f"{key}.mmd")
+    if not os.path.exists(tmp_path):
+        # Write to a private temp file and rename it into place, so a concurrent
+        # request or a crash mid-write can never leave a truncated file at tmp_path
+        tmp = tempfile.NamedTemporaryFile(dir=_MMD_DIR, suffix=".mmd", delete=False,
+                                          mode="w", encoding="utf-8")
+        try:
+            with tmp:
+                tmp.write(mermaid_code)
+            os.replace(tmp.name, tmp_path)
+        except BaseException:
+            # Don't leave the half-written delete=False file behind
+            os.unlink(tmp.name)
+            raise
 
     # Generate draw.io link
     drawio_xml_base64 = mermaid_to_drawio(mermaid_code)